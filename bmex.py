@@ -8,18 +8,37 @@ License: MIT
 """
 
 import argparse
+from collections import deque
 import csv
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
 from datetime import datetime as dt
 from datetime import timedelta
-from dateutil.parser import parse
+from typing import BinaryIO
+import functools
 import gzip
+import json
+import operator
 import os
+import random
 import requests
+from requests.adapters import HTTPAdapter
 import sys
+import tempfile
+import threading
 import time
 
+try:
+    # Optional: parses the bars (JSON) responses faster than the standard library.
+    from orjson import loads
+except ImportError:
+    from json import loads
+
 
 # https://www.bitmex.com/api/explorer/
+instruments_endpoint = (
+    "https://www.bitmex.com/api/v1/instrument?count=500&start={}&reverse=false"
+)
 bars_endpoint = "https://www.bitmex.com/api/v1/trade/bucketed?binSize={}&partial=false&symbol={}&count=500&start=0&reverse=false&startTime={}&endTime={}"
 
 # https://public.bitmex.com/?prefix=data/trade/
@@ -57,6 +76,25 @@ _headers = {
     ],
 }
 
+# Turns each bar (a dict) into a row with the fields in the order of its header.
+_bars_get = operator.itemgetter(*_headers["bars"])
+
+# Time spanned by a request for each bar (500 is the maximum number of results per
+# request).
+_bars_steps = {
+    "1m": timedelta(minutes=500),
+    "5m": timedelta(minutes=500 * 5),
+    "1h": timedelta(hours=500),
+    "1d": timedelta(days=500),
+}
+
+# Where the symbols of all instruments are cached, and for how long (in seconds).
+_instruments_cache = os.path.expanduser("~/.cache/bmex/instruments.json")
+_instruments_ttl = 24 * 60 * 60
+
+# Directories already created (or found) by this process.
+_ensured_dirs = set()
+
 
 def _validate_dates(start: dt, end: dt):
     """
@@ -79,17 +117,59 @@ def _validate_dates(start: dt, end: dt):
     return start, end
 
 
-def _validate_symbols(symbols: set):
+@functools.lru_cache(maxsize=None)
+def _instruments(
+    session: requests.Session, limiter: "_RateLimiter", refresh: bool = False
+):
     """
-    Validates that each symbol/index exists/existed on BitMEX.
+    Returns the symbols of every instrument ever listed on BitMEX.
+    They are cached on disk for a day, unless 'refresh' is set, and in memory for the
+    rest of the program.
     """
 
-    response = requests.get(
-        "https://www.bitmex.com/api/v1/instrument?count=500&reverse=false"
-    ).json()
+    if not refresh:
+        try:
+            if time.time() - os.path.getmtime(_instruments_cache) < _instruments_ttl:
+                with open(_instruments_cache) as f:
+                    return frozenset(json.load(f))
+        except (OSError, ValueError):
+            pass
+
+    # Each request returns at most 500 instruments.
+    symbols = []
+    start = 0
+    while True:
+        limiter.acquire()
+        response = session.get(instruments_endpoint.format(start), timeout=30)
+        response.raise_for_status()
+        page = response.json()
+        symbols.extend(field["symbol"] for field in page)
+        if len(page) < 500:
+            break
+        start += 500
+
+    # The cache is only an optimization: failing to write it is not an error.
+    try:
+        os.makedirs(os.path.dirname(_instruments_cache), exist_ok=True)
+        with open(_instruments_cache, "w") as f:
+            json.dump(symbols, f)
+    except OSError:
+        pass
+
+    return frozenset(symbols)
+
+
+def _validate_symbols(symbols: set, session: requests.Session, limiter: "_RateLimiter"):
+    """
+    Validates that each symbol/index exists/existed on BitMEX.
+    """
 
-    valid = [field["symbol"] for field in response]
+    valid = _instruments(session, limiter)
     not_valid = [symbol for symbol in symbols if symbol not in valid]
+    if not_valid:
+        # The cached instruments might predate these symbols.
+        valid = _instruments(session, limiter, refresh=True)
+        not_valid = [symbol for symbol in symbols if symbol not in valid]
 
     if not_valid:
         sys.exit(f"\nERROR: These symbols are not valid: {not_valid}.\n")
@@ -122,21 +202,6 @@ def _validate_path(save_to: str = None):
     return path
 
 
-def _unzip_quotes_trades(temp: str, response: dict):
-    """
-    Unzip downloaded .tar.gz file and parse the data inside.
-    """
-
-    with open(temp, "wb") as fp:
-        fp.write(response.content)
-
-    with gzip.open(temp, "rb") as fp:
-        data = fp.read()
-
-    with open(temp, "wb") as fp:
-        fp.write(data)
-
-
 def _delete_old(_file: str):
     """
     If the '_file' already exists, remove it and create a new one to which to append the
@@ -149,189 +214,475 @@ def _delete_old(_file: str):
         os.remove(_file)
 
 
-def _store_quotes_trades(start: str, symbols: set, channel: str, path: str):
+def _ensure_dir(location: str):
     """
-    Stores the data as .csv files on a pre-defined (see README.md) directory structure.
+    Creates the 'location' directory (and its parents), unless this was already done.
     """
 
-    new = True
-    header = {symbol: True for symbol in symbols}
-    temp = start.strftime("%Y%m%d")  # Points to the file.
+    if location not in _ensured_dirs:
+        os.makedirs(location, exist_ok=True)
+        _ensured_dirs.add(location)
 
-    with open(temp, newline="") as inp:
-        reader = csv.reader(inp)
-        for row in reader:
-            if row[1] in symbols:
-                symbol = row[1]
 
-                location = f"{path}/{symbol}/{channel}s/{start.year}/{start.month}"
-                if not os.path.isdir(location):
-                    os.makedirs(location)
+def _read_blocks(inp: BinaryIO, size: int = 1 << 20):
+    """
+    Reads 'inp' in blocks of about 'size' bytes, each made of whole lines.
+    Going through a large block at once, in C, is much faster than reading the lines
+    one by one.
+    """
 
-                _file = f"{location}/{temp[:4]}-{temp[4:6]}-{temp[6:]}.csv"
+    rest = b""
+    while True:
+        block = inp.read(size)
+        if not block:
+            break
 
-                if new:
-                    _delete_old(_file)
-                    new = False
+        # The last line of a block is usually partial: it is completed by the next one.
+        block = rest + block
+        cut = block.rfind(b"\n") + 1
+        rest = block[cut:]
+        if cut:
+            yield block[:cut]
 
-                # Pandas couldn't parse the dates - The next line fixes that.
-                row[0] = row[0].replace("D", "T", 1)
+    if rest:
+        yield rest
 
-                with open(_file, "a", newline="") as f:
-                    writer = csv.writer(f)
-                    if header[symbol]:
-                        writer.writerow(_headers[channel])
-                        header[symbol] = False
-                    writer.writerow(row)
 
-    os.remove(temp)
+def _store_quotes_trades(
+    start: dt, zipped: BinaryIO, symbols: set, channel: str, path: str
+):
+    """
+    Unzips the downloaded .csv.gz file and stores the data as .csv files on a
+    pre-defined (see README.md) directory structure.
+
+    Rows flow straight from the zipped data to the file of their symbol, which is
+    opened once per day: the unzipped data is never written to disk.
+    """
 
+    header = ",".join(_headers[channel]).encode() + b"\n"
+    day = start.strftime("%Y-%m-%d")
+
+    # Nothing below depends on the rows, so it is computed once per day.
+    wanted = frozenset(symbol.encode() for symbol in symbols)
+    locations = {
+        symbol.encode(): f"{path}/{symbol}/{channel}s/{start.year}/{start.month}"
+        for symbol in symbols
+    }
+    # A symbol is found in a block (as a whole field) by searching for its needle.
+    needles = {symbol: b"," + symbol + b"," for symbol in wanted}
+    # Pandas couldn't parse the dates - Every row of the day starts with 'bad_stamp',
+    # which is replaced by 'good_stamp'.
+    bad_stamp = day.encode() + b"D"
+    good_stamp = day.encode() + b"T"
+    files = {}
+    writes = {}  # Bound 'write' method of each file, to skip the lookup per row.
+
+    def _open(symbol: bytes):
+        location = locations[symbol]
+        _ensure_dir(location)
+
+        # "wb" mode replaces any old file (see _delete_old).
+        f = open(f"{location}/{day}.csv", "wb", buffering=1 << 22)
+        files[symbol] = f
+        write = writes[symbol] = f.write
+        write(header)
+        return write
+
+    try:
+        with gzip.GzipFile(fileobj=zipped) as inp:
+            for block in _read_blocks(inp):
+                # Blocks without any of the wanted symbols, and blocks made only of
+                # (well formed) rows of one of them, are handled in C, as a whole.
+                found = [symbol for symbol in wanted if needles[symbol] in block]
+                if not found:
+                    continue
 
-def poll_quotes_trades(start: dt, end: dt, symbols: set, channel: str, path: str):
+                if len(found) == 1 and block.endswith(b"\n"):
+                    symbol = found[0]
+                    rows = block.count(b"\n")
+                    if (
+                        block.count(needles[symbol]) == rows
+                        and block.startswith(bad_stamp)
+                        and block.count(b"\n" + bad_stamp) == rows - 1
+                    ):
+                        write = writes.get(symbol) or _open(symbol)
+                        write(block.replace(bad_stamp, good_stamp))
+                        continue
+
+                for line in block.splitlines(True):
+                    symbol = line.split(b",", 2)[1]
+                    if symbol in wanted:
+                        write = writes.get(symbol) or _open(symbol)
+
+                        # The "D" is always at index 10, where bytes.replace stops:
+                        # this is a single scan and a single copy of the line.
+                        write(line.replace(b"D", b"T", 1))
+    finally:
+        for f in files.values():
+            f.close()
+
+
+def _backoff(count: int, response: requests.Response = None):
     """
-    Polls data in daily blocks from BitMEX servers.
+    Returns for how many seconds to wait before retrying a failed request: as long as
+    the server asks for (Retry-After header), if it does, otherwise an exponential
+    backoff (capped at 60 seconds) with some jitter.
+    'response' is None when the request failed without one (e.g. a timeout).
     """
 
-    while start <= end:
-        # BitMEX names each zipped file by its date in the format below.
-        # We must download, unzip it and extract the data.
-        temp = start.strftime("%Y%m%d")
-        count = 0
-        while True:
-            response = requests.get(quotes_trades_endpoint.format(channel, temp))
+    # Not 'if response': a Response is falsy for the 4xx/5xx that are retried.
+    retry_after = ""
+    if response is not None:
+        retry_after = response.headers.get("Retry-After", "")
+    if retry_after.isdigit():
+        return int(retry_after)
+
+    return min(60, 2**count + random.random())
+
+
+def _fetch_quotes_trades(start: dt, channel: str, session: requests.Session):
+    """
+    Downloads the zipped file of a single day from BitMEX servers (runs on a worker
+    thread) into a temporary file. Returns None if the data is not (yet) available.
+    """
+
+    # BitMEX names each zipped file by its date in the format below.
+    temp = start.strftime("%Y%m%d")
+    count = 0
+    while True:
+        try:
+            response = session.get(
+                quotes_trades_endpoint.format(channel, temp), timeout=30, stream=True
+            )
             if response.status_code == 200:
-                break
-            else:
-                count += 1
-                if count == 10:
-                    if response.status_code == 404:
-                        # Data for today or yesterday might yet not be available.
-                        today = dt.today()
-                        yesterday = today - timedelta(1)
-                        if (
-                            start.date() == today.date()
-                            or start.date() == yesterday.date()
-                        ):
-                            return f"Failed to download: {start.date()} - data not (yet) available."
-                    response.raise_for_status()
-                print(
-                    f"ERROR: {response.status_code} while processing {start.date()} - retrying."
-                )
-                time.sleep(10)
+                # The body is written to disk in blocks of 1MB, as it arrives, instead
+                # of being held in memory as a whole.
+                zipped = tempfile.TemporaryFile()
+                try:
+                    with response:
+                        for chunk in response.iter_content(chunk_size=1 << 20):
+                            zipped.write(chunk)
+                except BaseException:
+                    zipped.close()
+                    raise
+                zipped.seek(0)
+                return zipped
+        except requests.RequestException as error:
+            # Connection errors and timeouts (also while downloading) are retried.
+            count += 1
+            if count == 10:
+                raise
+            delay = _backoff(count)
+            print(
+                f"ERROR: {error.__class__.__name__} while processing {start.date()} - retrying in {delay:.0f} seconds."
+            )
+            time.sleep(delay)
+            continue
+
+        response.close()
+        if response.status_code == 404:
+            # Data for today or yesterday might yet not be available: retrying
+            # (and backing off) would only delay the end of the program.
+            today = dt.today()
+            yesterday = today - timedelta(1)
+            if start.date() == today.date() or start.date() == yesterday.date():
+                return None
+        count += 1
+        if count == 10:
+            response.raise_for_status()
+        delay = _backoff(count, response)
+        print(
+            f"ERROR: {response.status_code} while processing {start.date()} - retrying in {delay:.0f} seconds."
+        )
+        time.sleep(delay)
+
+
+def poll_quotes_trades(
+    start: dt,
+    end: dt,
+    symbols: set,
+    channel: str,
+    path: str,
+    session: requests.Session,
+):
+    """
+    Polls data in daily blocks from BitMEX servers.
 
-        _unzip_quotes_trades(temp, response)
-        _store_quotes_trades(start, symbols, channel, path)
+    The following days are downloaded in the background while the current one is
+    unzipped and stored.
+    """
 
-        print(f"Processed {channel}s: {str(start)[:10]}")
-        start += timedelta(days=1)
+    # Number of days downloaded ahead.
+    prefetch = 4
+    pending = deque()
+    executor = ThreadPoolExecutor(max_workers=prefetch)
+    try:
+        while pending or start <= end:
+            while len(pending) < prefetch and start <= end:
+                future = executor.submit(_fetch_quotes_trades, start, channel, session)
+                pending.append((start, future))
+                start += timedelta(days=1)
+
+            day, future = pending.popleft()
+            zipped = future.result()
+            if zipped is None:
+                return f"Failed to download: {day.date()} - data not (yet) available."
+
+            with zipped:
+                _store_quotes_trades(day, zipped, symbols, channel, path)
+
+            print(f"Processed {channel}s: {str(day)[:10]}")
+    finally:
+        executor.shutdown(cancel_futures=True)
 
     return "Success - all data downloaded and stored."
 
 
+def _close_writers(writers: dict):
+    """
+    Closes the files of the cached bars writers (see _store_bars).
+    """
+
+    for f, _ in writers.values():
+        f.close()
+    writers.clear()
+
+
 def _store_bars(
-    data: list, end: dt, path: str, symbol: str, channel: str, bar: str, header: dt
+    data: list,
+    end: dt,
+    path: str,
+    symbol: str,
+    channel: str,
+    bar: str,
+    header: dt,
+    writers: dict,
 ):
     """
     Stores the data as .csv files on a pre-defined (see README.md) directory structure.
 
     Note: On the first time this function is called, 'header' will be of type None,
     subsequently it will be of type datetime.
+    'writers' maps the file being written to its (file, csv writer): it is kept open
+    across calls, as consecutive responses often hold bars of the same date, and is
+    closed (see _close_writers) once the next file is needed or by the caller.
     """
+    current = None  # Date of the file being written.
     for row in data:
-        date = parse(row["timestamp"]).date()
-        if date > end.date():
+        ts = row["timestamp"]  # Always in the format YYYY-MM-DDTHH:MM:SS.000Z
+        day = date(int(ts[0:4]), int(ts[5:7]), int(ts[8:10]))
+        if day > end.date():
             return
 
-        location = f"{path}/{symbol}/{channel}/{bar}/{date.year}/{date.month}"
-        if not os.path.isdir(location):
-            os.makedirs(location)
+        if day != current:
+            location = f"{path}/{symbol}/{channel}/{bar}/{day.year}/{day.month}"
+            _file = f"{location}/{ts[:10]}.csv"
+
+            if _file not in writers:
+                _close_writers(writers)
+                _ensure_dir(location)
 
-        d = date.strftime("%Y%m%d")
-        _file = f"{location}/{d[:4]}-{d[4:6]}-{d[6:]}.csv"
+                new = True if day != header else False
+                if new:
+                    _delete_old(_file)
 
-        new = True if date != header else False
-        if new:
-            _delete_old(_file)
+                f = open(_file, "a", newline="")
+                writers[_file] = (f, csv.writer(f))
 
-        with open(_file, "a", newline="") as f:
-            writer = csv.DictWriter(f, fieldnames=_headers[channel])
+            writer = writers[_file][1]
+            current = day
 
-            # "header" starts as None but from the 2nd iteration on it equals the last
-            # date. If the actual date (not datetime) is different than the previous one,
-            # a new header is written (on a new file).
-            if header != date:
-                writer.writeheader()
-                header = date
-            writer.writerow(row)
+            # "header" starts as None but from the 2nd iteration on it equals the
+            # last date. If the actual date (not datetime) is different than the
+            # previous one, a new header is written (on a new file).
+            if header != day:
+                writer.writerow(_headers[channel])
+                header = day
+        writer.writerow(_bars_get(row))
     return header
 
 
-def poll_bars(start: dt, end: dt, symbols: set, channel: str, bars: list, path: str):
+class _RateLimiter:
     """
-    Polls bars (time buckets of trades) from BitMEX servers.
-    Options are: [1m, 5m, 1h, 1d]
+    Leaky bucket shared by all the threads polling bars: at most 'limit' requests are
+    allowed per 'period' seconds, the tokens used being given back at every period.
+    It can also be paused (after a 429), which holds back every thread.
     """
 
-    # Number of requests made to the server.
-    req = 0
+    def __init__(self, limit: int = 30, period: int = 60):
+        self._tokens = threading.Semaphore(limit)
+        self._period = period
+        self._used = 0
+        self._resume = 0.0  # time.monotonic() at which the pause ends.
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        threading.Thread(target=self._refill, daemon=True).start()
+
+    def acquire(self):
+        self._tokens.acquire()
+        with self._lock:
+            self._used += 1
+
+        # A token taken before (or during) a pause is only used once it is over.
+        while True:
+            with self._lock:
+                wait = self._resume - time.monotonic()
+            if wait <= 0:
+                return
+            time.sleep(wait)
 
-    header = None
-    error = False
+    def pause(self, seconds: float):
+        with self._lock:
+            self._resume = max(self._resume, time.monotonic() + seconds)
+
+    def close(self):
+        self._stop.set()
+
+    def _refill(self):
+        while not self._stop.wait(self._period):
+            with self._lock:
+                used, self._used = self._used, 0
+            for _ in range(used):
+                self._tokens.release()
+
+
+def _bars_windows(start: dt, end: dt, symbols: set, bars: list):
+    """
+    Splits the requested period into the windows that must be polled, in the order
+    in which they are to be stored. Each window is a (symbol, bar, url, start date,
+    end) tuple, with the timestamps of its url formatted once, upfront.
+    """
 
     for symbol in symbols:
         for bar in bars:
             # Can't modify 'start' and 'end' directly.
             _start = start
             _end = end + timedelta(days=1)
+            e_iso = _end.isoformat()
+            step = _bars_steps[bar]
 
             while _start < _end:
-                if error:
-                    print("Success: continuing.")
-                    error = False
-
-                req += 1
-                # 30 is the maximum number of requests allowed per minute.
-                if req % 30 == 0:
-                    print(f"Respecting API limits - Sleeping for 60 seconds.")
-                    time.sleep(60)
-                    req = 0
-
-                response = requests.get(
-                    bars_endpoint.format(bar, symbol, str(_start), str(_end))
-                )
+                url = bars_endpoint.format(bar, symbol, _start.isoformat(), e_iso)
+                yield symbol, bar, url, _start.date(), _end
+                _start += step
 
-                # BitMEX API often throws a "429 - too many requests" error, even
-                # if we are respecting its limits.
-                if response.status_code == 429:
-                    error = True
-                    print(
-                        f"Failed to process: {_start.date()} - Sleeping for 60 seconds and retrying."
-                    )
-                    time.sleep(60)
-                    continue
 
-                data = response.json()
-                if not data:
-                    print(f"Data does not exist for {symbol}-{bar}: {_start.date()}")
-                    _start += timedelta(days=1)
-                    time.sleep(1)
-                    continue
+def _fetch_bars(url: str, day: date, session: requests.Session, limiter: _RateLimiter):
+    """
+    Fetches a single window of bars from BitMEX servers (runs on a worker thread).
+    """
+
+    # Number of failed attempts, and of consecutive ones that got no response (or a
+    # server error).
+    count = 0
+    errors = 0
+    while True:
+        limiter.acquire()
+        try:
+            response = session.get(url, timeout=30)
+        except requests.RequestException as error:
+            # Connection errors and timeouts are retried (at most 10 times in a row).
+            count += 1
+            errors += 1
+            if errors == 10:
+                raise
+            delay = _backoff(count)
+            print(
+                f"Failed to process: {day} ({error.__class__.__name__}) - Sleeping for {delay:.0f} seconds and retrying."
+            )
+            time.sleep(delay)
+            continue
+
+        # BitMEX API often throws a "429 - too many requests" error, even
+        # if we are respecting its limits.
+        if response.status_code == 429:
+            count += 1
+            errors = 0
+            delay = _backoff(count, response)
+            print(
+                f"Failed to process: {day} - Pausing all requests for {delay:.0f} seconds and retrying."
+            )
+            # The limit applies to the client as a whole: all the threads must wait.
+            limiter.pause(delay)
+            continue
+
+        # Server errors (e.g. 503 - overloaded) are usually transient and retried, but
+        # any other error is not: its body must not be stored as bars.
+        if response.status_code >= 500:
+            count += 1
+            errors += 1
+            if errors == 10:
+                response.raise_for_status()
+            delay = _backoff(count, response)
+            print(
+                f"Failed to process: {day} ({response.status_code}) - Sleeping for {delay:.0f} seconds and retrying."
+            )
+            time.sleep(delay)
+            continue
+        response.raise_for_status()
+
+        if count:
+            print("Success: continuing.")
+
+        return loads(response.content)
 
-                stored = _store_bars(data, _end, path, symbol, channel, bar, header)
-                if stored:
-                    header = stored
 
-                print(f"Processed {symbol} {bar}-bars: {_start.date()}")
+def poll_bars(
+    start: dt,
+    end: dt,
+    symbols: set,
+    channel: str,
+    bars: list,
+    path: str,
+    session: requests.Session,
+    limiter: "_RateLimiter",
+):
+    """
+    Polls bars (time buckets of trades) from BitMEX servers.
+    Options are: [1m, 5m, 1h, 1d]
+
+    Requests are made concurrently (within the API limits), but the responses are
+    stored in order, from the main thread, so that each file has a single writer.
+    """
+
+    header = None
+    writers = {}
+
+    # Number of windows requested ahead: twice the threads, to keep them all busy
+    # while only holding a few responses in memory.
+    workers = 8
+    prefetch = 2 * workers
+    windows = _bars_windows(start, end, symbols, bars)
+    pending = deque()
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        while True:
+            for window in windows:
+                _, _, url, day, _ = window
+                future = executor.submit(_fetch_bars, url, day, session, limiter)
+                pending.append((window, future))
+                if len(pending) >= prefetch:
+                    break
+            if not pending:
+                break
+
+            (symbol, bar, _, day, _end), future = pending.popleft()
+            data = future.result()
+            if not data:
+                print(f"Data does not exist for {symbol}-{bar}: {day}")
+                continue
 
-                # 500 is the maximum number of results per request.
-                if bar == "1m":
-                    _start += timedelta(minutes=500)
-                elif bar == "5m":
-                    _start += timedelta(minutes=500 * 5)
-                elif bar == "1h":
-                    _start += timedelta(hours=500)
-                else:
-                    _start += timedelta(days=500)
+            stored = _store_bars(
+                data, _end, path, symbol, channel, bar, header, writers
+            )
+            if stored:
+                header = stored
+
+            print(f"Processed {symbol} {bar}-bars: {day}")
+    finally:
+        executor.shutdown(cancel_futures=True)
+        _close_writers(writers)
 
     return "Success - all data downloaded and stored."
 
@@ -349,7 +700,23 @@ def _separator(channel=None):
         print("------")
 
 
-def _transform_validate(args):
+def _new_session():
+    """
+    Creates a session whose connection pool keeps the sockets to BitMEX (API and S3)
+    alive across requests, so that only the first request pays for the handshakes.
+    """
+
+    session = requests.Session()
+    # requests already asks for compressed responses and keep-alive connections.
+    session.headers["User-Agent"] = "bmex/1.0"
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32, max_retries=0)
+    session.mount("https://www.bitmex.com", adapter)
+    session.mount("https://s3-eu-west-1.amazonaws.com", adapter)
+
+    return session
+
+
+def _transform_validate(args, session: requests.Session, limiter: _RateLimiter):
     """
     Transforms and validates the arguments passed to the main function.
     """
@@ -372,7 +739,7 @@ def _transform_validate(args):
     else:
         bars = None
 
-    symbols = _validate_symbols(symbols)
+    symbols = _validate_symbols(symbols, session, limiter)
     start, end = _validate_dates(start, end)
     path = _validate_path(args.save_to)
 
@@ -381,17 +748,29 @@ def _transform_validate(args):
 
 def main(args):
 
-    symbols, channels, start, end, bars, path = _transform_validate(args)
-
-    report = {}
-    for channel in channels:
-        _separator(channel)
-        if channel == "bars":
-            report[channel] = poll_bars(start, end, symbols, channel, bars, path)
-        else:
-            report[channel] = poll_quotes_trades(
-                start, end, symbols, channel[:-1], path
-            )
+    session = _new_session()
+    # Shared by all the requests to the API (not S3): 30 is the maximum number of
+    # requests allowed per minute.
+    limiter = _RateLimiter(30, 60)
+    try:
+        symbols, channels, start, end, bars, path = _transform_validate(
+            args, session, limiter
+        )
+
+        report = {}
+        for channel in channels:
+            _separator(channel)
+            if channel == "bars":
+                report[channel] = poll_bars(
+                    start, end, symbols, channel, bars, path, session, limiter
+                )
+            else:
+                report[channel] = poll_quotes_trades(
+                    start, end, symbols, channel[:-1], path, session
+                )
+    finally:
+        limiter.close()
+        session.close()
 
     _separator()
     for channel, status in report.items():